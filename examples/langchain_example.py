@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any, Dict, List
 
 import boto3
@@ -14,7 +15,11 @@ def metadata_callback(ocj: Any) -> Dict[str, Any]:
     return {"conversation_id": 123}
 
 
-new_relic_monitor = NewRelicCallbackHandler(
+# the handler keeps a stack of open spans, so every concurrent run gets its own
+openai_monitor = NewRelicCallbackHandler(
+    "LangChain observability trace", metadata_callback=metadata_callback
+)
+bedrock_monitor = NewRelicCallbackHandler(
     "LangChain observability trace", metadata_callback=metadata_callback
 )
 
@@ -52,10 +57,26 @@ def get_agent(llm: LLM, tools: List[Tool]):
 
 
 openai_agent = get_agent(openai_llm, tools)
-openai_agent.run("What is 2 + 2?", callbacks=[new_relic_monitor])
-
 bedrock_agent = get_agent(bedrock_llm, tools)
-bedrock_agent.run("What is 2 + 2?", callbacks=[new_relic_monitor])
+
+
+async def runLangchainOpenAI(prompt: str):
+    return await openai_agent.arun(prompt, callbacks=[openai_monitor])
+
+
+async def runLangchainBedrock(prompt: str):
+    # the Bedrock LLM has no async implementation, so run it on the default executor
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, lambda: bedrock_agent.run(prompt, callbacks=[bedrock_monitor])
+    )
+
+
+async def main(prompt: str):
+    await asyncio.gather(runLangchainOpenAI(prompt), runLangchainBedrock(prompt))
+
+
+asyncio.run(main("What is 2 + 2?"))
 
 
 print("Agent run successfully!")
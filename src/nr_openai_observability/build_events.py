@@ -1,7 +1,10 @@
 import logging
+import os
+import random
+import time
 import uuid
 from ast import Dict
-from datetime import datetime
+from functools import lru_cache
 from typing import Any, Tuple
 
 import openai
@@ -10,48 +13,111 @@ from newrelic_telemetry_sdk import Span
 
 logger = logging.getLogger("nr_openai_observability")
 
+_DISABLE_TOKEN_COUNT = os.environ.get("NR_OPENAI_DISABLE_TOKEN_COUNT", "0") == "1"
+_RECORD_MESSAGES = os.environ.get("NR_OPENAI_RECORD_MESSAGES", "1") == "1"
+_FAST_UUID = os.environ.get("NR_OPENAI_FAST_UUID", "0") == "1"
 
-def _build_messages_events(messages, completion_id, model):
-    events = []
-    for index, message in enumerate(messages):
-        currMessage = {
-            "id": str(uuid.uuid4()),
-            "content": message.get("content", "")[:4095],
-            "role": message.get("role"),
-            "completion_id": completion_id,
-            "sequence": index,
-            "model": model,
-            "vendor": "openAI",
-            "ingest_source": "PythonSDK",
-        }
+_rng = random.Random(os.urandom(16))
 
-        events.append(currMessage)
 
-    return events
+def _reseed_rng():
+    # a forked child would otherwise generate the same ids as its parent
+    _rng.seed(os.urandom(16))
 
 
-def _get_rate_limit_data(response_headers):
-    def _get_numeric_header(name):
-        header = response_headers.get(name)
-        return int(header) if header and header.isdigit() else None
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_rng)
+
+
+def _fast_uuid():
+    return str(uuid.UUID(int=_rng.getrandbits(128), version=4))
+
+
+def _event_id():
+    return _fast_uuid() if _FAST_UUID else str(uuid.uuid4())
+
 
+def _truncate(value, max_length=4095):
+    # most values are already short enough, so skip the slice for them
+    if value is None or len(value) <= max_length:
+        return value
+    return value[:max_length]
+
+
+def _api_key_tail(api_key):
+    return f"sk-{api_key[-4:]}"
+
+
+def _build_message_event(index, message, completion_id, model):
     return {
-        "ratelimit_limit_requests": _get_numeric_header("ratelimit_limit_requests"),
-        "ratelimit_limit_tokens": _get_numeric_header("ratelimit_limit_tokens"),
-        "ratelimit_reset_tokens": response_headers.get("x-ratelimit-reset-tokens"),
-        "ratelimit_reset_requests": response_headers.get("x-ratelimit-reset-requests"),
-        "ratelimit_remaining_tokens": _get_numeric_header("ratelimit_remaining_tokens"),
-        "ratelimit_remaining_requests": _get_numeric_header(
-            "ratelimit_remaining_requests"
-        ),
+        "id": _event_id(),
+        "content": _truncate(message.get("content", "")),
+        "role": message.get("role"),
+        "completion_id": completion_id,
+        "sequence": index,
+        "model": model,
+        "vendor": "openAI",
+        "ingest_source": "PythonSDK",
     }
 
 
-def calc_completion_tokens(model, message_content):
+def _build_messages_events(messages, completion_id, model):
+    if not _RECORD_MESSAGES:
+        return []
+
+    return [
+        _build_message_event(index, message, completion_id, model)
+        for index, message in enumerate(messages)
+    ]
+
+
+def _add_rate_limit_data(event, response_headers):
+    def _get_numeric_header(name):
+        try:
+            return int(response_headers.get(name))
+        except (TypeError, ValueError):
+            return None
+
+    event["ratelimit_limit_requests"] = _get_numeric_header("ratelimit_limit_requests")
+    event["ratelimit_limit_tokens"] = _get_numeric_header("ratelimit_limit_tokens")
+    event["ratelimit_reset_tokens"] = response_headers.get("x-ratelimit-reset-tokens")
+    event["ratelimit_reset_requests"] = response_headers.get(
+        "x-ratelimit-reset-requests"
+    )
+    event["ratelimit_remaining_tokens"] = _get_numeric_header(
+        "ratelimit_remaining_tokens"
+    )
+    event["ratelimit_remaining_requests"] = _get_numeric_header(
+        "ratelimit_remaining_requests"
+    )
+
+
+@lru_cache(maxsize=32)
+def _get_encoding(model):
+    # loading the BPE is expensive, so each model's encoding is built once and reused
     try:
-        encoding = tiktoken.encoding_for_model(model)
-        # could not find encoding for model
+        return tiktoken.encoding_for_model(model)
     except KeyError:
+        # could not find encoding for model
+        return None
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(model, text):
+    # chat history is resent on every request, so only new messages miss the cache
+    return len(_get_encoding(model).encode(text))
+
+
+def _is_supported_model(model):
+    return "gpt-4" in model or "gpt-3" in model
+
+
+def calc_completion_tokens(model, message_content):
+    if not _is_supported_model(model):
+        return None
+
+    encoding = _get_encoding(model)
+    if encoding is None:
         return None
 
     return len(encoding.encode(message_content))
@@ -62,10 +128,12 @@ def calc_prompt_tokens(model, messages):
     calculate prompt tokens based on this document
     https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-        # could not find encoding for model
-    except KeyError:
+    if not _is_supported_model(model):
+        logger.warn(f"model:{model} is unsupported for streaming token calculation")
+        return None
+
+    encoding = _get_encoding(model)
+    if encoding is None:
         return None
 
     num_of_tokens_per_msg = 3
@@ -75,18 +143,16 @@ def calc_prompt_tokens(model, messages):
         num_of_tokens_per_msg = 4
         num_of_tokens_per_name = -1
 
-    if "gpt-4" not in model and "gpt-3" not in model:
-        logger.warn(f"model:{model} is unsupported for streaming token calculation")
-        return None
-
     num_of_tokens = 3  # this is based on the link in the docstring, every reply contains base 3 tokens that are added tp the prompt
-
-    for message in messages:
-        num_of_tokens += num_of_tokens_per_msg
-        for key, value in message.items():
-            num_of_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_of_tokens += num_of_tokens_per_name
+    num_of_tokens += num_of_tokens_per_msg * len(messages)
+    num_of_tokens += num_of_tokens_per_name * sum(
+        1 for message in messages if "name" in message
+    )
+    num_of_tokens += sum(
+        _count_tokens(model, value)
+        for message in messages
+        for value in message.values()
+    )
 
     return num_of_tokens
 
@@ -97,10 +163,17 @@ def build_stream_completion_events(
     completion_id = str(uuid.uuid4())
     request_messages = request.get("messages", [])
 
-    prompt_tokens = calc_prompt_tokens(last_chunk.model, request_messages)
-    completion_tokens = calc_completion_tokens(
-        last_chunk.model, message.get("content", "")
-    )
+    usage = getattr(last_chunk, "usage", None)
+    if usage:
+        prompt_tokens = usage.prompt_tokens
+        completion_tokens = usage.completion_tokens
+    elif _DISABLE_TOKEN_COUNT:
+        prompt_tokens, completion_tokens = None, None
+    else:
+        prompt_tokens = calc_prompt_tokens(last_chunk.model, request_messages)
+        completion_tokens = calc_completion_tokens(
+            last_chunk.model, message.get("content", "")
+        )
     total_tokens = (
         completion_tokens + prompt_tokens
         if completion_tokens and prompt_tokens
@@ -109,7 +182,7 @@ def build_stream_completion_events(
 
     completion = {
         "id": completion_id,
-        "api_key_last_four_digits": f"sk-{last_chunk.api_key[-4:]}",
+        "api_key_last_four_digits": _api_key_tail(last_chunk.api_key),
         "response_time": int(response_time * 1000),
         "request.model": request.get("model") or request.get("engine"),
         "response.model": last_chunk.model,
@@ -122,13 +195,13 @@ def build_stream_completion_events(
         "api_type": last_chunk.api_type,
         "vendor": "openAI",
         "ingest_source": "PythonSDK",
-        "number_of_messages": len(request.get("messages", [])) + 1,
+        "number_of_messages": len(request_messages) + 1,
         "organization": last_chunk.organization,
         "api_version": response_headers.get("openai-version"),
         "stream": True,
     }
 
-    completion.update(_get_rate_limit_data(response_headers))
+    _add_rate_limit_data(completion, response_headers)
 
     messages = _build_messages_events(
         request_messages + [message],
@@ -141,10 +214,11 @@ def build_stream_completion_events(
 
 def build_completion_events(response, request, response_headers, response_time):
     completion_id = str(uuid.uuid4())
+    request_messages = request.get("messages", [])
 
     completion = {
         "id": completion_id,
-        "api_key_last_four_digits": f"sk-{response.api_key[-4:]}",
+        "api_key_last_four_digits": _api_key_tail(response.api_key),
         "response_time": int(response_time * 1000),
         "request.model": request.get("model") or request.get("engine"),
         "response.model": response.model,
@@ -157,16 +231,16 @@ def build_completion_events(response, request, response_headers, response_time):
         "api_type": response.api_type,
         "vendor": "openAI",
         "ingest_source": "PythonSDK",
-        "number_of_messages": len(request.get("messages", [])) + len(response.choices),
+        "number_of_messages": len(request_messages) + len(response.choices),
         "organization": response.organization,
         "api_version": response_headers.get("openai-version"),
         "stream": False,
     }
 
-    completion.update(_get_rate_limit_data(response_headers))
+    _add_rate_limit_data(completion, response_headers)
 
     messages = _build_messages_events(
-        request.get("messages", []) + [response.choices[0].message],
+        request_messages + [response.choices[0].message],
         completion_id,
         response.model,
     )
@@ -176,17 +250,19 @@ def build_completion_events(response, request, response_headers, response_time):
 
 def build_completion_error_events(request, error, isStream=False):
     completion_id = str(uuid.uuid4())
+    request_messages = request.get("messages", [])
+    request_model = request.get("model") or request.get("engine")
 
     completion = {
         "id": completion_id,
-        "api_key_last_four_digits": f"sk-{openai.api_key[-4:]}",
-        "request.model": request.get("model") or request.get("engine"),
+        "api_key_last_four_digits": _api_key_tail(openai.api_key),
+        "request.model": request_model,
         "temperature": request.get("temperature"),
         "max_tokens": request.get("max_tokens"),
         "vendor": "openAI",
         "ingest_source": "PythonSDK",
         "organization": error.organization,
-        "number_of_messages": len(request.get("messages", [])),
+        "number_of_messages": len(request_messages),
         "error_status": error.http_status,
         "error_message": error.error.message,
         "error_type": error.error.type,
@@ -196,22 +272,22 @@ def build_completion_error_events(request, error, isStream=False):
     }
 
     messages = _build_messages_events(
-        request.get("messages", []),
+        request_messages,
         completion_id,
-        request.get("model") or request.get("engine"),
+        request_model,
     )
 
     return {"messages": messages, "completion": completion}
 
 
 def build_embedding_event(response, request, response_headers, response_time):
-    embedding_id = str(uuid.uuid4())
+    embedding_id = _event_id()
 
     embedding = {
         "id": embedding_id,
-        "input": request.get("input")[:4095],
-        "api_key_last_four_digits": f"sk-{response.api_key[-4:]}",
-        "timestamp": datetime.now(),
+        "input": _truncate(request.get("input")),
+        "api_key_last_four_digits": _api_key_tail(response.api_key),
+        "timestamp": int(time.time() * 1000),
         "response_time": int(response_time * 1000),
         "request.model": request.get("model") or request.get("engine"),
         "response.model": response.model,
@@ -224,17 +300,17 @@ def build_embedding_event(response, request, response_headers, response_time):
         "api_version": response_headers.get("openai-version"),
     }
 
-    embedding.update(_get_rate_limit_data(response_headers))
+    _add_rate_limit_data(embedding, response_headers)
     return embedding
 
 
 def build_embedding_error_event(request, error):
-    embedding_id = str(uuid.uuid4())
+    embedding_id = _event_id()
 
     embedding = {
         "id": embedding_id,
-        "api_key_last_four_digits": f"sk-{openai.api_key[-4:]}",
-        "timestamp": datetime.now(),
+        "api_key_last_four_digits": _api_key_tail(openai.api_key),
+        "timestamp": int(time.time() * 1000),
         "request.model": request.get("model") or request.get("engine"),
         "vendor": "openAI",
         "ingest_source": "PythonSDK",
@@ -264,3 +340,16 @@ def span_to_event(span: Span):
         table=span["attributes"]["name"],
         event_dict=event_dict,
     )
+
+
+def _prewarm_encodings():
+    # pay the BPE load at import time instead of on the first streamed completion
+    for model in ("gpt-3.5-turbo", "gpt-4", "gpt-4o"):
+        try:
+            _get_encoding(model)
+        except Exception as ex:
+            logger.debug(f"Failed to prewarm tiktoken encoding for {model}: {ex}")
+
+
+if os.environ.get("NR_OPENAI_PREWARM_TIKTOKEN", "1") == "1":
+    _prewarm_encodings()